@@ -1,11 +1,16 @@
 from enum import Enum
 import logging
+import os
 from pathlib import Path
 import pytest
 import random
+import shutil
+import stat
+import sys
 import tempfile
 from time import sleep
-from utils.TwoPhaser import two_phase_open
+import uuid
+from utils.TwoPhaser import _is_writable, two_phase_open
 
 logger = logging.getLogger(__name__)
 
@@ -17,72 +22,130 @@ class WhichFiles(Enum):
 
 class ByWhichFiles():
     def __init__(self):
-        self._data = {
-            WhichFiles.PRIMARY: None, 
-            WhichFiles.BACKUP: None, 
-            WhichFiles.TEMPORARY: None, 
-            WhichFiles.TEMPORARY: None, }
+        # One slot per WhichFiles member indexed by value - 1
+        self._data = [None, None, None, None]
     def __getitem__(self, which):
-        return self._data[which]
+        return self._data[which.value - 1]
+    def __setitem__(self, which, value):
+        self._data[which.value - 1] = value
     @property
     def primary(self):
-        return self._data[WhichFiles.PRIMARY]
+        return self._data[0]
     @property
     def backup(self):
-        return self._data[WhichFiles.BACKUP]
+        return self._data[1]
     @property
     def temporary(self):
-        return self._data[WhichFiles.TEMPORARY]
+        return self._data[2]
     @property
     def probe(self):
-        return self._data[WhichFiles.PROBE]
+        return self._data[3]
 
 class TwoPhaserStageTexts(ByWhichFiles):
     text_characters = ' abcdefghijklmnopqrstuvwxyz'
+    # Maps every byte value onto text_characters so random bytes can be turned
+    # into text in one call
+    text_table = bytes.maketrans(bytes(range(256)), (text_characters * (256 // len(text_characters) + 1))[:256].encode('ascii'))
     def __init__(self):
         super().__init__()
-        self._data[WhichFiles.PRIMARY] = self._generate_text(1*1024)
-        self._data[WhichFiles.BACKUP] = self._generate_text(2*1024)
-        self._data[WhichFiles.TEMPORARY] = self._generate_text(3*1024)
-        # self._data[WhichFiles.PROBE] should never be used
-    def _generate_text(self, how_many):
-        return ''.join([random.choice(TwoPhaserStageTexts.text_characters) for i1 in range(how_many)])
+        # The encoded form of each text is kept so staging files does not
+        # have to encode the same text over and over
+        self._encoded = [None, None, None, None]
+        self._generate_text(WhichFiles.PRIMARY, 1*1024)
+        self._generate_text(WhichFiles.BACKUP, 2*1024)
+        self._generate_text(WhichFiles.TEMPORARY, 3*1024)
+        # self[WhichFiles.PROBE] should never be used
+    def encoded(self, which):
+        return self._encoded[which.value - 1]
+    @property
+    def primary_bytes(self):
+        return self._encoded[0]
+    @property
+    def backup_bytes(self):
+        return self._encoded[1]
+    @property
+    def temporary_bytes(self):
+        return self._encoded[2]
+    def _generate_text(self, which, how_many):
+        raw = random.getrandbits(8*how_many).to_bytes(how_many, 'little')
+        encoded = raw.translate(TwoPhaserStageTexts.text_table)
+        self._encoded[which.value - 1] = encoded
+        self[which] = encoded.decode('ascii')
 
 class TwoPhaserStageFiles(ByWhichFiles):
-    def __init__(self, texts=None):
+    # Stage on tmpfs when it is available.  The tests do not need the files
+    # to survive a crash and /tmp is often a real disk.
+    if os.path.isdir('/dev/shm') and os.access('/dev/shm', os.W_OK):
+        temporary_root = '/dev/shm'
+    else:
+        temporary_root = None
+    def __init__(self, texts=None, root=None):
         super().__init__()
         if texts is None:
             texts = TwoPhaserStageTexts()
         self._texts = texts
+        if root is None:
+            root = Path(TwoPhaserStageFiles.temporary_root or tempfile.gettempdir())
+        self._root = root
     def __enter__(self):
-        self._temporary_directory = tempfile.TemporaryDirectory()
-        self._directory = Path(self._temporary_directory.name)
-        stem = ''.join([random.choice('abcdefghijklmnopqrstuvwxyz') for i1 in range(8)])
-        self._stem = stem
+        self._directory = self._root / uuid.uuid4().hex
+        self._directory.mkdir()
+        self._stem = os.urandom(8).hex()
         self._base = self._directory / self._stem
-        self._data[WhichFiles.PRIMARY] = self._base.with_suffix('.txt')
-        self._data[WhichFiles.BACKUP] = self._base.with_suffix('.txt.bak')
-        self._data[WhichFiles.TEMPORARY] = self._base.with_suffix('.txt.tmp')
-        self._data[WhichFiles.PROBE] = self._base.with_suffix('.txt.prb')
+        self[WhichFiles.PRIMARY] = self._base.with_suffix('.txt')
+        self[WhichFiles.BACKUP] = self._base.with_suffix('.txt.bak')
+        self[WhichFiles.TEMPORARY] = self._base.with_suffix('.txt.tmp')
+        self[WhichFiles.PROBE] = self._base.with_suffix('.txt.prb')
         return self
     def __exit__(self, exc_type, exc_value, traceback):
-        self._temporary_directory.cleanup()
+        shutil.rmtree(str(self._directory))
         assert not self._directory.exists()
         return False
     def _prepare_file(self, which):
-        path = self._data[which]
-        text = self._texts[which]
-        path.write_text(text)
+        path = self[which]
+        path.write_bytes(self._texts.encoded(which))
     def prepare_files(self, which):
-        for path in self._data.values():
-            if path.exists():
+        for path in self._data:
+            try:
                 path.unlink()
+            except FileNotFoundError:
+                pass
         if isinstance(which, Enum):
             self._prepare_file(which)
         else:
             for w1 in which:
                 self._prepare_file(w1)
 
+@pytest.fixture
+def sync_events(monkeypatch):
+    # Records the fsync and rename calls in the order they are made
+    events = []
+    real_fsync = os.fsync
+    real_replace = os.replace
+    def fsync(fd):
+        events.append(('fsync', 'directory' if stat.S_ISDIR(os.fstat(fd).st_mode) else 'file'))
+        real_fsync(fd)
+    def replace(path_from, path_to):
+        events.append(('replace', Path(path_from).name, Path(path_to).name))
+        real_replace(path_from, path_to)
+    # Use fsync for files on every platform so the calls can be recorded
+    monkeypatch.setattr('utils.TwoPhaser.fcntl', None)
+    monkeypatch.setattr(os, 'fsync', fsync)
+    monkeypatch.setattr(os, 'replace', replace)
+    return events
+
+@pytest.fixture(scope="session")
+def staged_texts():
+    # The tests only need distinct texts so one set is shared by all of them
+    return TwoPhaserStageTexts()
+
+@pytest.fixture(scope="session")
+def stage_root():
+    # One directory for the session.  Each test stages its files in a new
+    # subdirectory.
+    with tempfile.TemporaryDirectory(dir=TwoPhaserStageFiles.temporary_root) as name:
+        yield Path(name)
+
 def x_test_dump_texts(caplog):
     caplog.set_level(logging.INFO)
     test_me = TwoPhaserStageTexts()
@@ -93,26 +156,93 @@ def x_test_dump_texts(caplog):
     logger.info(test_me[WhichFiles.TEMPORARY])
     logger.info(test_me.temporary)
 
-def test_simple_read_failure(caplog):
+def test_simple_read_failure(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    with TwoPhaserStageFiles() as stage_files:
+    with TwoPhaserStageFiles(staged_texts, stage_root) as stage_files:
         with pytest.raises(FileNotFoundError):
             with two_phase_open(stage_files.primary, 'r') as f:
                 text = f.read()
 
-def test_simple_read_success(caplog):
+def test_missing_directory_failure(caplog, staged_texts, stage_root):
+    caplog.set_level(logging.INFO)
+    with TwoPhaserStageFiles(staged_texts, stage_root) as stage_files:
+        missing = stage_files.primary.parent / 'missing' / stage_files.primary.name
+        with pytest.raises(FileNotFoundError):
+            with two_phase_open(missing, 'r') as f:
+                text = f.read()
+        with pytest.raises(FileNotFoundError):
+            with two_phase_open(missing, 'w') as f:
+                f.write('never written')
+
+@pytest.mark.parametrize('args, kwargs, expected', [
+    ((), {}, False),
+    (('r',), {}, False),
+    (('rb',), {}, False),
+    (('rt',), {}, False),
+    (('r+',), {}, True),
+    (('w',), {}, True),
+    (('wb',), {}, True),
+    (('a',), {}, True),
+    (('x',), {}, True),
+    ((), {'mode': 'r'}, False),
+    ((), {'mode': 'rb'}, False),
+    ((), {'mode': 'w'}, True),
+    ((), {'mode': 'a+'}, True),
+    ])
+def test_is_writable(args, kwargs, expected):
+    assert _is_writable(args, kwargs) == expected
+
+def test_mode_keyword_write_read_success(caplog, staged_texts, stage_root):
+    caplog.set_level(logging.INFO)
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
+        with two_phase_open(stage_files.primary, mode='x') as f:
+            assert str(stage_files.temporary) == f.name
+            f.write(texts.primary)
+        assert stage_files.primary.exists()
+        assert not stage_files.temporary.exists()
+        with two_phase_open(stage_files.primary, mode='rb') as f:
+            assert str(stage_files.primary) == f.name
+            assert texts.primary_bytes == f.read()
+        # Appending goes to the new temporary file
+        with two_phase_open(stage_files.primary, 'a') as f:
+            assert str(stage_files.temporary) == f.name
+            f.write(texts.backup)
+        with two_phase_open(stage_files.primary, 'rb') as f:
+            assert texts.backup_bytes == f.read()
+        assert texts.primary_bytes == stage_files.backup.read_bytes()
+
+@pytest.mark.skipif(sys.version_info < (3, 6), reason="os.PathLike requires Python 3.6")
+def test_pathlike_write_read_success(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    texts = TwoPhaserStageTexts()
-    with TwoPhaserStageFiles(texts) as stage_files:
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
+        stage_files.prepare_files({WhichFiles.PRIMARY})
+        # A DirEntry is an os.PathLike whose str() is not its path
+        with os.scandir(str(stage_files.primary.parent)) as entries:
+            entry = next(e for e in entries if e.name == stage_files.primary.name)
+        with two_phase_open(entry, 'r') as f:
+            assert str(stage_files.primary) == f.name
+            assert texts.primary == f.read()
+        with two_phase_open(entry, 'w') as f:
+            assert str(stage_files.temporary) == f.name
+            f.write(texts.backup)
+        assert sorted(p.name for p in stage_files.primary.parent.iterdir()) == sorted([stage_files.primary.name, stage_files.backup.name])
+        assert texts.backup_bytes == stage_files.primary.read_bytes()
+
+def test_simple_read_success(caplog, staged_texts, stage_root):
+    caplog.set_level(logging.INFO)
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
         stage_files.prepare_files({WhichFiles.PRIMARY})
         with two_phase_open(stage_files.primary, 'r') as f:
             assert str(stage_files.primary) == f.name
             assert texts.primary == f.read()
 
-def test_simple_write_read_success(caplog):
+def test_simple_write_read_success(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    texts = TwoPhaserStageTexts()
-    with TwoPhaserStageFiles(texts) as stage_files:
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
         # First write: primary exists, backup does not
         with two_phase_open(stage_files.primary, 'w') as f:
             assert str(stage_files.temporary) == f.name
@@ -135,7 +265,7 @@ def test_simple_write_read_success(caplog):
         with two_phase_open(stage_files.primary, 'r') as f:
             assert str(stage_files.primary) == f.name
             assert texts.backup == f.read()
-        assert texts.primary == stage_files.backup.read_text()
+        assert texts.primary_bytes == stage_files.backup.read_bytes()
         # Third write: both exist
         with two_phase_open(stage_files.primary, 'w') as f:
             assert str(stage_files.temporary) == f.name
@@ -147,12 +277,33 @@ def test_simple_write_read_success(caplog):
         with two_phase_open(stage_files.primary, 'r') as f:
             assert str(stage_files.primary) == f.name
             assert texts.temporary == f.read()
-        assert texts.backup == stage_files.backup.read_text()
+        assert texts.backup_bytes == stage_files.backup.read_bytes()
 
-def test_recovery_havetemporary_haveprimary_nobackup(caplog):
+def test_identical_write_preserves_backup(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    texts = TwoPhaserStageTexts()
-    with TwoPhaserStageFiles(texts) as stage_files:
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
+        stage_files.prepare_files({WhichFiles.PRIMARY, WhichFiles.BACKUP})
+        # Rewriting the same data leaves the backup alone
+        with two_phase_open(stage_files.primary, 'w') as f:
+            f.write(texts.primary)
+        assert stage_files.primary.exists()
+        assert stage_files.backup.exists()
+        assert not stage_files.temporary.exists()
+        assert texts.primary_bytes == stage_files.primary.read_bytes()
+        assert texts.backup_bytes == stage_files.backup.read_bytes()
+        # Same size but different data still rotates the backup
+        changed = texts.primary[1:] + texts.primary[0]
+        with two_phase_open(stage_files.primary, 'w') as f:
+            f.write(changed)
+        with two_phase_open(stage_files.primary, 'r') as f:
+            assert changed == f.read()
+        assert texts.primary_bytes == stage_files.backup.read_bytes()
+
+def test_recovery_havetemporary_haveprimary_nobackup(caplog, staged_texts, stage_root):
+    caplog.set_level(logging.INFO)
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
         # Have Temporary, Have Primary, No Backup --> no recovery (rollback)
         stage_files.prepare_files({WhichFiles.TEMPORARY, WhichFiles.PRIMARY})
         with two_phase_open(stage_files.primary, 'r') as f:
@@ -163,10 +314,10 @@ def test_recovery_havetemporary_haveprimary_nobackup(caplog):
         assert not stage_files.temporary.exists()
         assert not stage_files.probe.exists()
 
-def test_recovery_havetemporary_haveprimary_havebackup(caplog):
+def test_recovery_havetemporary_haveprimary_havebackup(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    texts = TwoPhaserStageTexts()
-    with TwoPhaserStageFiles(texts) as stage_files:
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
         # Have Temporary, Have Primary, Have Backup 
         #   --> no recovery (rollback)
         stage_files.prepare_files({WhichFiles.TEMPORARY, WhichFiles.PRIMARY, WhichFiles.BACKUP})
@@ -178,10 +329,10 @@ def test_recovery_havetemporary_haveprimary_havebackup(caplog):
         assert not stage_files.temporary.exists()
         assert not stage_files.probe.exists()
 
-def test_recovery_havetemporary_noprimary_havebackup(caplog):
+def test_recovery_havetemporary_noprimary_havebackup(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    texts = TwoPhaserStageTexts()
-    with TwoPhaserStageFiles(texts) as stage_files:
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
         # Have Temporary, No Primary, Have Backup 
         #   --> recover (commit)
         stage_files.prepare_files({WhichFiles.TEMPORARY, WhichFiles.BACKUP})
@@ -193,10 +344,47 @@ def test_recovery_havetemporary_noprimary_havebackup(caplog):
         assert not stage_files.temporary.exists()
         assert not stage_files.probe.exists()
 
-def test_recovery_havetemporary_noprimary_nobackup(caplog):
+@pytest.mark.skipif(not hasattr(os, 'O_DIRECTORY'), reason="directories cannot be synced")
+def test_write_sync_order(caplog, staged_texts, stage_root, sync_events):
+    caplog.set_level(logging.INFO)
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
+        stage_files.prepare_files({WhichFiles.PRIMARY})
+        with two_phase_open(stage_files.primary, 'w') as f:
+            f.write(texts.backup)
+        assert sync_events == [
+            ('fsync', 'file'),
+            ('replace', stage_files.primary.name, stage_files.backup.name),
+            ('fsync', 'directory'),
+            ('replace', stage_files.temporary.name, stage_files.primary.name),
+            ('fsync', 'directory'), ]
+        assert texts.backup_bytes == stage_files.primary.read_bytes()
+        assert texts.primary_bytes == stage_files.backup.read_bytes()
+
+@pytest.mark.skipif(not hasattr(os, 'O_DIRECTORY'), reason="directories cannot be synced")
+def test_recovery_sync_order(caplog, staged_texts, stage_root, sync_events):
+    caplog.set_level(logging.INFO)
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
+        # Rolling forward while reading is synced
+        stage_files.prepare_files({WhichFiles.TEMPORARY, WhichFiles.BACKUP})
+        with two_phase_open(stage_files.primary, 'r') as f:
+            assert texts.temporary == f.read()
+        assert sync_events == [
+            ('replace', stage_files.temporary.name, stage_files.primary.name),
+            ('fsync', 'directory'), ]
+        # Removing the temporary file while reading is synced
+        del sync_events[:]
+        stage_files.prepare_files({WhichFiles.TEMPORARY, WhichFiles.PRIMARY})
+        with two_phase_open(stage_files.primary, 'r') as f:
+            assert texts.primary == f.read()
+        assert not stage_files.temporary.exists()
+        assert sync_events == [('fsync', 'directory'), ]
+
+def test_recovery_havetemporary_noprimary_nobackup(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    texts = TwoPhaserStageTexts()
-    with TwoPhaserStageFiles(texts) as stage_files:
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
         # Have Temporary, No Primary, No Backup 
         #   --> no recovery (rollback)
         stage_files.prepare_files({WhichFiles.TEMPORARY})
@@ -209,10 +397,10 @@ def test_recovery_havetemporary_noprimary_nobackup(caplog):
         assert not stage_files.temporary.exists()
         assert not stage_files.probe.exists()
 
-def test_recovery_notemporary_noprimary_havebackup_reading(caplog):
+def test_recovery_notemporary_noprimary_havebackup_reading(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    texts = TwoPhaserStageTexts()
-    with TwoPhaserStageFiles(texts) as stage_files:
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
         # No Temporary, No Primary, Have Backup, Reading 
         #   --> read from the Backup
         stage_files.prepare_files({WhichFiles.BACKUP})
@@ -223,10 +411,10 @@ def test_recovery_notemporary_noprimary_havebackup_reading(caplog):
         assert stage_files.backup.exists()
         assert not stage_files.temporary.exists()
 
-def test_recovery_notemporary_noprimary_havebackup_writing(caplog):
+def test_recovery_notemporary_noprimary_havebackup_writing(caplog, staged_texts, stage_root):
     caplog.set_level(logging.INFO)
-    texts = TwoPhaserStageTexts()
-    with TwoPhaserStageFiles(texts) as stage_files:
+    texts = staged_texts
+    with TwoPhaserStageFiles(texts, stage_root) as stage_files:
         # No Temporary, No Primary, Have Backup, Writing 
         #   --> preserve Backup but otherwise a normal commit
         stage_files.prepare_files({WhichFiles.BACKUP})
@@ -240,4 +428,4 @@ def test_recovery_notemporary_noprimary_havebackup_writing(caplog):
         with two_phase_open(stage_files.primary, 'r') as f:
             assert str(stage_files.primary) == f.name
             assert texts.primary == f.read()
-        assert texts.backup == stage_files.backup.read_text()
+        assert texts.backup_bytes == stage_files.backup.read_bytes()
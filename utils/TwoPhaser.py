@@ -41,17 +41,22 @@
 
   - Notes...
     - Rename is assumed to be atomic
+    - Syncing the directory is only possible on POSIX systems
     - This implementation does not support concurrency / locking
     - Checking last write time on the files would be an interesting addition but
       only marginally useful
 
   - If there is a temporary file (1a) and a primary...
-    - The presumption is that a failure occurred at or before 1b
+    - The presumption is that a failure occurred before the primary was
+      renamed to the backup or, if the contents were identical and that
+      rename was skipped, before 2
     - There is no way to know if 1b was reached
+    - Either way the primary holds complete data
     - Delete the temporary file
 
-  - If there is a temporary file (1a), no primary, and a backup (1c + 1d)...
-    - The presumption is that a failure occurred between 1d and 2
+  - If there is a temporary file (1a), no primary, and a backup...
+    - The presumption is that a failure occurred after the primary was
+      renamed to the backup and before 2
     - Rename the temporary file to the primary file
 
   - If there is a temporary file (1a), no primary, and no backup...
@@ -60,7 +65,7 @@
 
   - If there is no temporary, a backup, and no primary...
     - The presumption is that the human deleted the primary so the backup would take affect
-    - Rename the backup file to the primary file
+    - Read from the backup file; it is not renamed
 
   - If there is no temporary, a backup, and a primary...
     - All good!
@@ -76,124 +81,251 @@
   - Open the temporary file for writing
   - Phase 1a
   - Write data
+  - Flush and sync the temporary file
   - Close the temporary file
   - Phase 1b
-  - If it exists, delete the backup file
+  - If the primary is identical to the temporary file, skip to 1c
+  - Rename the primary file to the backup file replacing any existing backup
+  - Sync the directory
   - Phase 1c
-  - Rename the primary file to the backup file
-  - Phase 1d
   - Rename the temporary file to the primary file
+  - Sync the directory
   - Phase 2
 
   Reading...
   - Recover
   - Open the primary file for reading
+  - If there is no primary, open the backup file for reading
 """
 
 from exceptions.WritableMismatch import WritableMismatch
 
+import functools
 import logging
+import os
 import pathlib
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 logger = logging.getLogger(__name__)
 
+# os.fspath and os.PathLike were added in Python 3.6.  Before that str is
+# enough since the only paths are str and pathlib.
+_fspath = getattr(os, 'fspath', str)
+
+def _is_writable(remaining_args, kwargs):
+    """Determine if open would return a writable file without opening one.
+
+    Mirrors the mode analysis performed by the io module: any of 'w', 'a',
+    'x', or '+' in the mode means the file is writable.  The default mode is
+    'r'.
+    """
+    if 'mode' in kwargs:
+        mode = kwargs['mode']
+    elif len(remaining_args) >= 1:
+        mode = remaining_args[0]
+    else:
+        mode = 'r'
+    return any(c in mode for c in 'wax+')
+
+@functools.lru_cache(maxsize=256)
+def _sibling_paths(primary):
+    """Return the primary, backup, and temporary paths for a primary file.
+
+    Cached so the typical caller repeatedly opening the same cache file does
+    not rebuild the paths on every open.
+    """
+    primary_path = pathlib.Path(primary)
+    backup_path = primary_path.with_name(primary_path.name + '.bak')
+    temporary_path = primary_path.with_name(primary_path.name + '.tmp')
+    return (primary_path, backup_path, temporary_path)
+
+def _sync_file(f):
+    """Flush a file object and force its data to the storage device.
+
+    On macOS fsync does not flush the drive cache; F_FULLFSYNC does.
+    """
+    f.flush()
+    if hasattr(fcntl, 'F_FULLFSYNC'):
+        fcntl.fcntl(f.fileno(), fcntl.F_FULLFSYNC)
+    else:
+        os.fsync(f.fileno())
+
+def _same_contents(path1, path2):
+    """Determine if two files hold the same bytes."""
+    with open(path1, 'rb') as f1, open(path2, 'rb') as f2:
+        while True:
+            b1 = f1.read(65536)
+            b2 = f2.read(65536)
+            if b1 != b2:
+                return False
+            if not b1:
+                return True
+
 class TwoPhaser:
     def __init__(self, args, kwargs):
         self._file = None
+        self._directory_fd = None
         self._args = args
         self._kwargs = kwargs
+        self._str = None
     def __enter__(self):
-        logger.debug("%s.__enter__()", self)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s.__enter__()", self)
         # Prepare arguments for calling open
-        primary_path = pathlib.Path(self._args[0])
         remaining_args = self._args[1:]
         kwargs = self._kwargs
         # Determine paths to the three files
-        self._primary_path = primary_path
-        self._backup_path = primary_path.parent / (primary_path.name + '.bak')
-        self._temporary_path = primary_path.parent / (primary_path.name + '.tmp')
-        # Probe to determine if the caller wants to write
-        probe_path = primary_path.parent / (primary_path.name + '.prb')
-        try:
-            try:
-                with probe_path.open(*remaining_args, **kwargs) as f1:
-                    self._writable = f1.writable()
-            finally:
-                if probe_path.exists():
-                    probe_path.unlink()
-        except FileNotFoundError:
-            self._writable = False
+        self._primary_path, self._backup_path, self._temporary_path = _sibling_paths(_fspath(self._args[0]))
+        # String forms used to open, rename, and delete so the hot path does no
+        # Path operations
+        self._primary_str = str(self._primary_path)
+        self._backup_str = str(self._backup_path)
+        self._temporary_str = str(self._temporary_path)
+        # Determine from the mode if the caller wants to write
+        self._writable = _is_writable(remaining_args, kwargs)
         # Try to recover if there was a failure.  This has to be done before
-        # determining the path_to_use.
+        # opening the file.
         self._recover()
         # Writing goes to the temporary file.  Reading is from the primary file.
         # Unless there is a backup with no primary then reading is from the
-        # backup file.
+        # backup file.  Ready for business.
         if self._writable:
-            path_to_use = self._temporary_path
+            self._file = open(self._temporary_str, *remaining_args, **kwargs)
         else:
-            if self._backup_path.exists() and not self._primary_path.exists():
-                path_to_use = self._backup_path
-                logger.warning("Backup file %s exists with no primary.  Reading from the backup file.", self._backup_path)
-            else:
-                path_to_use = self._primary_path
-        # Ready for business.
-        self._file = path_to_use.open(*remaining_args, **kwargs)
+            self._file = self._open_for_reading(remaining_args, kwargs)
         try:
-            self._writable_actual = self._file.writable()
-            if self._writable != self._writable_actual:
-                raise WritableMismatch()
-            logger.debug("%s.__enter__(): success: %s", self, self._file)
+            # The directory is synced after each commit rename so the renames
+            # are durable and occur in order.
+            if self._writable and hasattr(os, 'O_DIRECTORY'):
+                self._directory_fd = os.open(str(self._primary_path.parent), os.O_RDONLY | os.O_DIRECTORY)
+            # The mode analysis is deterministic so the check is only made
+            # when not optimizing
+            if __debug__:
+                if self._writable != self._file.writable():
+                    raise WritableMismatch()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("%s.__enter__(): success: %s", self, self._file)
         except:
             self._close(False)
             raise
         return self._file
     def __exit__(self, exception_type, exception_value, trace_back):
-        logger.debug("%s.__exit__()", self)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s.__exit__()", self)
         self._close(exception_type is None)
         return False
     def __str__(self):
-        return "TwoPhaser({}, {})".format(self._args, self._kwargs)
+        # Built on first use and cached since it is only needed for logging
+        if self._str is None:
+            self._str = "TwoPhaser({}, {})".format(self._args, self._kwargs)
+        return self._str
     def _close(self, normal):
-        if self._file is not None:
-            self._file.close()
-            self._file = None
-            if self._writable:
-                if normal:
-                    if self._primary_path.exists():
-                        self._safe_delete(self._backup_path)
-                        self._safe_rename(self._primary_path, self._backup_path)
-                    self._safe_rename(self._temporary_path, self._primary_path)
-                else:
-                    self._safe_delete(self._temporary_path)
+        try:
+            if self._file is not None:
+                try:
+                    if self._writable and normal:
+                        _sync_file(self._file)
+                finally:
+                    self._file.close()
+                    self._file = None
+                if self._writable:
+                    if normal:
+                        if self._primary_differs():
+                            # The stat in _primary_differs confirmed the
+                            # primary exists.  os.replace overwrites the backup
+                            # so checking and deleting it first is unnecessary.
+                            self._rename(self._primary_str, self._backup_str)
+                            self._sync_directory()
+                        self._rename(self._temporary_str, self._primary_str)
+                        self._sync_directory()
+                    else:
+                        self._safe_delete(self._temporary_str)
+        finally:
+            if self._directory_fd is not None:
+                os.close(self._directory_fd)
+                self._directory_fd = None
+    def _primary_differs(self):
+        """Determine if the primary exists and differs from the temporary.
+
+        Rewriting identical data is common for a cache so in that case the
+        backup is left alone.  Comparing sizes avoids reading the files in
+        most cases where the data changed.
+        """
+        try:
+            primary_size = os.stat(self._primary_str).st_size
+        except FileNotFoundError:
+            return False
+        if primary_size != os.stat(self._temporary_str).st_size:
+            return True
+        return not _same_contents(self._primary_str, self._temporary_str)
+    def _open_for_reading(self, remaining_args, kwargs):
+        try:
+            return open(self._primary_str, *remaining_args, **kwargs)
+        except FileNotFoundError as primary_error:
+            try:
+                f1 = open(self._backup_str, *remaining_args, **kwargs)
+            except FileNotFoundError:
+                raise primary_error from None
+        logger.warning("Backup file %s exists with no primary.  Reading from the backup file.", self._backup_path)
+        return f1
     def _recover(self):
-        logger.debug("%s._recover()", self)
-        if self._temporary_path.exists():
-            logger.warning("Temporary file %s exists.  Recovery from a failure is necessary.", self._temporary_path)
-            if self._primary_path.exists():
-                logger.warning("Failure at or before 1b.  Removing the temporary file.")
-                self._safe_delete(self._temporary_path)
+        """Recover from a failure.
+
+        The common case is no temporary file so that is checked first with a
+        single stat call.  Only when recovery is necessary are the primary and
+        backup checked.
+        """
+        # A backup with no primary is deliberately not renamed to become the
+        # primary.  Reading falls back to the backup in _open_for_reading.
+        try:
+            os.lstat(self._temporary_str)
+        except FileNotFoundError:
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s._recover()", self)
+        logger.warning("Temporary file %s exists.  Recovery from a failure is necessary.", self._temporary_path)
+        if os.path.lexists(self._primary_str):
+            logger.warning("Failure before the backup rename.  Removing the temporary file.")
+            self._safe_delete(self._temporary_str)
+        else:
+            if os.path.lexists(self._backup_str):
+                logger.warning("Failure after the backup rename.  Rolling forward.")
+                self._safe_rename(self._temporary_str, self._primary_str)
             else:
-                if self._backup_path.exists():
-                    logger.warning("Failure between 1d and 2.  Rolling forward.")
-                    self._safe_rename(self._temporary_path, self._primary_path)
-                else:
-                    logger.warning("The first primary has not yet been created.  Removing the temporary file.")
-                    self._safe_delete(self._temporary_path)
-        #elif self._backup_path.exists() and not self._primary_path.exists():
-        #    logger.warning("Backup file %s exists with no primary: recovery from a failure is necessary.", self._backup_path)
-        #    logger.warning("Backup renamed to become the primary.")
-        #    self._safe_rename(self._backup_path, self._primary_path)
+                logger.warning("The first primary has not yet been created.  Removing the temporary file.")
+                self._safe_delete(self._temporary_str)
+        self._sync_directory()
+    def _sync_directory(self):
+        if self._directory_fd is not None:
+            os.fsync(self._directory_fd)
+        elif hasattr(os, 'O_DIRECTORY'):
+            # Recovery runs before the descriptor is opened and usually while
+            # reading so a descriptor is opened just for the sync
+            directory_fd = os.open(str(self._primary_path.parent), os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(directory_fd)
+            finally:
+                os.close(directory_fd)
     def _safe_delete(self, path):
         try:
-            logger.debug("Delete %s", path)
-            path.unlink()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Delete %s", path)
+            os.unlink(path)
         except FileNotFoundError:
             pass
+    def _rename(self, path_from, path_to):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("Rename %s to %s", path_from, path_to)
+        os.replace(path_from, path_to)
     def _safe_rename(self, path_from, path_to):
         try:
-            logger.debug("Rename %s to %s", path_from, path_to)
-            path_from.rename(path_to)
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Rename %s to %s", path_from, path_to)
+            os.replace(path_from, path_to)
         except FileNotFoundError:
             pass
 
@@ -209,7 +341,8 @@ def two_phase_open(*args, **kwargs):
     
     Raises:
         WritableMismatch: An internal check that indicates the code failed to
-            correctly determine is-writable.
+            correctly determine is-writable.  Not checked when running with
+            -O.
         Various I/O exceptions.
 
     Returns: